@@ -1,18 +1,37 @@
+import time
+_startup_t0 = time.perf_counter()
 import os
+import io
 import logging
-import time
 import tempfile
 import shutil
 import asyncio
 from logging.handlers import RotatingFileHandler
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaDocument
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
 from telegram.error import BadRequest
-from PIL import Image, ImageEnhance
-import pillow_heif
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, UploadFile, File, Form, HTTPException
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 import uvicorn
 import threading
+import functools
+import sys
+import glob
+import json
+import hashlib
+import argparse
+import zipfile
+import sqlite3
+import copy
+from collections import OrderedDict
+from typing import List
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+# Pillow và pillow_heif chỉ được import khi cần (xem load_codecs) để server khởi động nhanh
+Image = None
+ImageEnhance = None
+pillow_heif = None
+_codecs_lock = threading.Lock()
 
 # Khởi tạo FastAPI
 app = FastAPI()
@@ -20,17 +39,77 @@ app = FastAPI()
 # Biến toàn cục để lưu Application
 application = None
 
+# Trạng thái khởi động: webhook nhận update ngay, nhưng chỉ xử lý khi bot đã sẵn sàng
+bot_ready = False
+pending_updates = []
+MAX_PENDING_UPDATES = 1000
+_queued_update_tasks = set()  # Giữ tham chiếu tới task xử lý update đã xếp hàng
+startup_report = {}
+
+# Giới hạn bộ nhớ cho các job render đang chạy (byte), xem render_image
+RENDER_BYTES_PER_PIXEL_OVERHEAD = 4  # Mỗi bản RGBA: bản sau convert + một bản crop/resize cho mỗi biến thể
+DRAFT_FORMATS = ('JPEG', 'MPO')
+# Ảnh lớn hơn ngưỡng này được resize theo từng dải để không giữ nhiều bản sao toàn khung
+TILED_PIXEL_THRESHOLD = 40 * 1000 * 1000
+# Sai khác tối đa (mức/kênh) của đường resize theo dải so với đường thường. RGBA được resample
+# ở dạng premultiplied nên kênh màu lệch tới ~255/alpha mức: 4 là giới hạn khi alpha >= 64
+TILED_MAX_PIXEL_DIFF = {'RGB': 1, 'L': 1, 'RGBA': 4}
+TILEABLE_MODES = ('RGB', 'RGBA', 'L')
+HEIF_BRANDS = (b'heic', b'heix', b'hevc', b'hevx', b'heim', b'heis', b'hevm', b'hevs', b'mif1', b'msf1', b'avif', b'avis')
+TILE_STRIP_HEIGHT = 256
+OUTPUT_MEMORY_OVERHEAD = 1920 * 2400 * 4 * 3  # Ảnh đầu ra RGBA + bản RGB khi lưu + dải đang resample
+PREVIEW_ENABLED = os.environ.get('RENDER_PREVIEW', '1') != '0'
+PREVIEW_SIZE = 512
+render_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 2, thread_name_prefix='render')
+render_memory_in_use = 0
+_render_memory_condition = None
+render_stats = {'admitted': 0, 'queued': 0, 'downscaled': 0, 'rejected': 0}
+
+def default_memory_budget():
+    budget_mb = os.getenv("RENDER_MEMORY_BUDGET_MB")
+    if budget_mb:
+        return int(budget_mb) * 1024 * 1024
+    try:
+        available = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        available = 1024 * 1024 * 1024
+    # Trong container, giới hạn cgroup thường nhỏ hơn RAM của host
+    try:
+        with open('/sys/fs/cgroup/memory.max') as f:
+            limit = f.read().strip()
+        if limit != 'max':
+            available = min(available, int(limit))
+    except (OSError, ValueError):
+        pass
+    return max(available // 2, 256 * 1024 * 1024)
+
+render_memory_budget = default_memory_budget()
+
 # Endpoint kiểm tra trạng thái
 @app.get("/")
 async def root():
-    return {"message": "Telegram bot is running"}
+    return {
+        "message": "Telegram bot is running",
+        "ready": bot_ready,
+        "startup": startup_report,
+        "render": {"memory_in_use": render_memory_in_use, "memory_budget": render_memory_budget, "source_cache": source_cache_bytes, **render_stats},
+    }
 
 # Endpoint webhook
 @app.post("/webhook")
 async def webhook(request: Request):
     global application
     try:
-        update = Update.de_json(await request.json(), application.bot)
+        data = await request.json()
+        if not bot_ready:
+            if len(pending_updates) >= MAX_PENDING_UPDATES:
+                # 503 để Telegram gửi lại update sau, thay vì coi là đã nhận
+                logger.warning("Startup update queue is full, asking Telegram to retry")
+                return JSONResponse({"status": "error", "message": "Bot is starting"}, status_code=503)
+            pending_updates.append(data)
+            logger.info(f"Bot not ready yet, queued update ({len(pending_updates)} pending)")
+            return {"status": "queued"}
+        update = Update.de_json(data, application.bot)
         await application.process_update(update)
         return {"status": "ok"}
     except Exception as e:
@@ -48,245 +127,638 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Hàm process_image (giữ nguyên)
-def process_image(input_path, logo_paths, output_path, crop_type='square', logo_positions=None, opacities=None, logo_choice=None):
+def load_codecs():
+    global Image, ImageEnhance, pillow_heif
+    if Image is not None:
+        return
+    with _codecs_lock:
+        if Image is not None:
+            return
+        from PIL import Image as _Image, ImageEnhance as _ImageEnhance
+        import pillow_heif as _pillow_heif
+        ImageEnhance = _ImageEnhance
+        pillow_heif = _pillow_heif
+        Image = _Image
+
+# Các biến thể khi chọn "Tất cả định dạng": (crop_type, hậu tố tên file)
+CROP_VARIANTS = [('square', 'square'), ('4:5', '4x5'), ('keep', 'original')]
+
+# Danh sách logo khai báo trong Logo/logos.json, thêm brand mới không cần sửa code
+LOGO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Logo')
+LOGO_REGISTRY_PATH = os.path.join(LOGO_DIR, 'logos.json')
+DEFAULT_LOGO_AREA_RATIO = 0.036
+# Neo vị trí theo nửa khoảng trống còn lại: 0 = sát trái/trên, 1 = giữa, 2 = sát phải/dưới
+LOGO_POSITION_ANCHORS = {
+    'top-left': (0, 0),
+    'top-right': (2, 0),
+    'bottom-left': (0, 2),
+    'bottom-right': (2, 2),
+    'center': (1, 1),
+    'middle-top': (1, 0),
+    'middle-bottom': (1, 2),
+}
+LOGO_POSITIONS = list(LOGO_POSITION_ANCHORS)
+POSITION_LABELS = {
+    'top-left': "Góc trên - trái",
+    'top-right': "Góc trên - phải",
+    'bottom-left': "Góc dưới - trái",
+    'bottom-right': "Góc dưới - phải",
+    'center': "Ở giữa ảnh - độ mờ tùy chỉnh",
+    'middle-top': "Giữa - Phía trên",
+    'middle-bottom': "Giữa - Phía dưới",
+}
+
+def load_logo_registry(registry_path=LOGO_REGISTRY_PATH):
+    with open(registry_path, encoding='utf-8') as f:
+        entries = json.load(f)
+    registry = {}
+    for entry in entries:
+        # id nằm trong callback_data tách bằng '_'
+        if '_' in entry['id'] or entry['id'] in ('multi', 'no_logo'):
+            raise ValueError(f"Invalid logo id: {entry['id']}")
+        registry[entry['id']] = {
+            'id': entry['id'],
+            'path': os.path.join(os.path.dirname(registry_path), entry['path']),
+            'name': entry['name'],
+            'area_ratio': entry.get('area_ratio', DEFAULT_LOGO_AREA_RATIO),
+            'positions': [position for position in entry.get('positions', LOGO_POSITIONS) if position in LOGO_POSITION_ANCHORS],
+            'margin': entry.get('margin', 0),
+        }
+    return registry
+
+logo_registry = load_logo_registry()
+logo_registry_by_path = {entry['path']: entry for entry in logo_registry.values()}
+LOGO_CHOICES = list(logo_registry)
+
+def get_logo_entry(logo_path):
+    entry = logo_registry_by_path.get(logo_path)
+    if entry is None:
+        # Logo ngoài registry (ví dụ đường dẫn tùy ý) dùng thông số mặc định
+        entry = {'id': None, 'path': logo_path, 'name': os.path.basename(logo_path), 'area_ratio': DEFAULT_LOGO_AREA_RATIO, 'positions': LOGO_POSITIONS, 'margin': 0}
+    return entry
+
+# Cache logo đã decode, dùng chung cho mọi ảnh (chỉ đọc, không sửa trực tiếp)
+_logo_cache = {}
+# Cache overlay đã scale + áp độ mờ + cắt theo vùng alpha, theo (logo, kích thước ảnh, độ mờ)
+# Giới hạn theo dung lượng RGBA (không theo số mục) vì overlay của mỗi tỉ lệ ảnh có kích thước khác nhau
+LOGO_OVERLAY_CACHE_BYTES = 64 * 1024 * 1024
+_overlay_cache = OrderedDict()
+_overlay_cache_bytes = 0
+_overlay_lock = threading.Lock()
+
+def get_logo(logo_path):
+    logo = _logo_cache.get(logo_path)
+    if logo is None:
+        load_codecs()
+        logo = Image.open(logo_path).convert('RGBA')
+        _logo_cache[logo_path] = logo
+    return logo
+
+def lookup_overlay(key):
+    with _overlay_lock:
+        cached = _overlay_cache.get(key)
+        if cached is None:
+            return None
+        _overlay_cache.move_to_end(key)
+        return cached[0]
+
+def store_overlay(key, value, nbytes):
+    global _overlay_cache_bytes
+    with _overlay_lock:
+        previous = _overlay_cache.pop(key, None)
+        if previous is not None:
+            _overlay_cache_bytes -= previous[1]
+        _overlay_cache[key] = (value, nbytes)
+        _overlay_cache_bytes += nbytes
+        while _overlay_cache_bytes > LOGO_OVERLAY_CACHE_BYTES and len(_overlay_cache) > 1:
+            _, (_, evicted_bytes) = _overlay_cache.popitem(last=False)
+            _overlay_cache_bytes -= evicted_bytes
+
+def get_logo_overlay(logo_path, image_size, opacity):
+    key = (logo_path, image_size, opacity)
+    overlay = lookup_overlay(key)
+    if overlay is not None:
+        return overlay
+
+    entry = get_logo_entry(logo_path)
+    logo = get_logo(logo_path)
+    target_logo_area = image_size[0] * image_size[1] * entry['area_ratio']
+    scale_factor = (target_logo_area / (logo.width * logo.height)) ** 0.5
+    logo_width = int(logo.width * scale_factor)
+    logo_height = int(logo.height * scale_factor)
+    logo = logo.resize((logo_width, logo_height), Image.LANCZOS)
+    logger.info(f"Logo: {logo_path}, Target Area: {target_logo_area}, Size: {logo_width}x{logo_height}")
+
+    if opacity < 1.0:
+        alpha = logo.split()[3]
+        alpha = ImageEnhance.Brightness(alpha).enhance(opacity)
+        logo.putalpha(alpha)
+
+    # Phần trong suốt không làm thay đổi ảnh khi paste, chỉ giữ vùng có alpha
+    bbox = logo.getchannel('A').getbbox()
+    if bbox is None:
+        overlay = (None, (0, 0), (logo_width, logo_height))
+    else:
+        overlay = (logo.crop(bbox), bbox[:2], (logo_width, logo_height))
+
+    store_overlay(key, overlay, overlay[0].width * overlay[0].height * 4 if overlay[0] is not None else 0)
+    return overlay
+
+def get_logo_set_overlay(logo_specs, image_size):
+    # Trả về danh sách (overlay, vị trí paste). Chỉ các logo chồng lên nhau mới được gộp
+    # (alpha "over" theo thứ tự); logo tách rời được paste riêng để không tạo canvas bao trùm cả ảnh
+    if len(logo_specs) > 1:
+        key = (logo_specs, image_size)
+        pastes = lookup_overlay(key)
+        if pastes is not None:
+            return pastes
+
+    layers = []
+    for logo_path, logo_position, opacity in logo_specs:
+        overlay, offset, logo_size = get_logo_overlay(logo_path, image_size, opacity)
+        if overlay is None:
+            continue
+        paste_position = compute_logo_position(image_size, logo_size, logo_position, get_logo_entry(logo_path)['margin'])
+        x, y = paste_position[0] + offset[0], paste_position[1] + offset[1]
+        layers.append((len(layers), overlay, (x, y, x + overlay.width, y + overlay.height)))
+
+    # Gom nhóm theo giao nhau của bounding box (bắc cầu), giữ thứ tự chồng lớp trong mỗi nhóm
+    groups = []
+    for layer in layers:
+        box = layer[2]
+        group = [layer]
+        for other in groups[:]:
+            if any(box[0] < b[2] and b[0] < box[2] and box[1] < b[3] and b[1] < box[3] for _, _, b in other):
+                groups.remove(other)
+                group = other + group
+        groups.append(group)
+
+    pastes = []
+    merged_bytes = 0
+    for group in groups:
+        if len(group) == 1:
+            _, overlay, box = group[0]
+            pastes.append((overlay, box[:2]))
+            continue
+        group.sort()
+        left = min(box[0] for _, _, box in group)
+        top = min(box[1] for _, _, box in group)
+        right = max(box[2] for _, _, box in group)
+        bottom = max(box[3] for _, _, box in group)
+        canvas = Image.new('RGBA', (right - left, bottom - top), (0, 0, 0, 0))
+        for _, overlay, box in group:
+            canvas.alpha_composite(overlay, (box[0] - left, box[1] - top))
+        pastes.append((canvas, (left, top)))
+        merged_bytes += canvas.width * canvas.height * 4
+
+    # Overlay đơn lẻ đã nằm trong cache của get_logo_overlay, chỉ cache khi có nhóm được gộp
+    if merged_bytes:
+        store_overlay(key, pastes, merged_bytes)
+    return pastes
+
+def compute_logo_position(image_size, logo_size, logo_position, margin=0):
+    anchor = LOGO_POSITION_ANCHORS.get(logo_position)
+    if anchor is None:
+        return (0, 0)
+    margin_px = int(min(image_size) * margin)
+    return (
+        (image_size[0] - logo_size[0]) * anchor[0] // 2 + (1 - anchor[0]) * margin_px,
+        (image_size[1] - logo_size[1]) * anchor[1] // 2 + (1 - anchor[1]) * margin_px,
+    )
+
+def warm_up(logo_paths):
+    warm_start = time.perf_counter()
+    load_codecs()
+    startup_report['codec_import'] = round(time.perf_counter() - warm_start, 3)
+    Image.init()
+    buffer = io.BytesIO()
+    Image.new('RGB', (16, 16)).save(buffer, 'JPEG', quality=98, optimize=True)
+    buffer.seek(0)
+    Image.open(buffer).convert('RGBA')
+    for logo_path in logo_paths:
+        get_logo(logo_path)
+    startup_report['warm_up'] = round(time.perf_counter() - warm_start, 3)
+    logger.info(f"Codecs and {len(logo_paths)} logos warmed up in {startup_report['warm_up']:.2f} seconds")
+
+def is_heif_file(input_path):
+    # Nhận diện HEIC/HEIF theo magic bytes (box "ftyp" + brand), không dựa vào đuôi file
+    with open(input_path, 'rb') as f:
+        header = f.read(12)
+    return header[4:8] == b'ftyp' and header[8:12] in HEIF_BRANDS
+
+def decode_heif(input_path):
+    # Decode thẳng ra RGB(A): frombuffer dùng chung buffer của libheif khi mode cho phép,
+    # nếu không chỉ copy đúng một lần; không convert sang RGBA toàn khung
+    heif_file = pillow_heif.open_heif(input_path, convert_hdr_to_8bit=True)
+    return Image.frombuffer(
+        heif_file.mode,
+        heif_file.size,
+        heif_file.data,
+        "raw",
+        heif_file.mode,
+        heif_file.stride,
+        1,
+    )
+
+def probe_image(input_path):
+    # Chỉ đọc header, chưa decode pixel
+    load_codecs()
+    if is_heif_file(input_path):
+        heif_file = pillow_heif.open_heif(input_path)
+        width, height = heif_file.size
+        return width, height, heif_file.mode, 'HEIF'
+    with Image.open(input_path) as img:
+        return img.width, img.height, img.mode, img.format
+
+def mode_bands(mode):
+    if mode in ('1', 'L', 'P'):
+        return 1
+    return 4 if 'A' in mode or mode == 'CMYK' else 3
+
+def use_tiled_path(width, height, mode):
+    return width * height > TILED_PIXEL_THRESHOLD and mode in TILEABLE_MODES
+
+def estimate_render_memory(width, height, mode, variants=1):
+    bands = mode_bands(mode)
+    if use_tiled_path(width, height, mode):
+        return width * height * bands + OUTPUT_MEMORY_OVERHEAD * variants
+    if mode in TILEABLE_MODES:
+        # Bản decode + một bản crop ở mode gốc cho mỗi biến thể
+        return width * height * bands * (1 + variants) + OUTPUT_MEMORY_OVERHEAD * variants
+    return width * height * (bands + RENDER_BYTES_PER_PIXEL_OVERHEAD * (1 + variants))
+
+def choose_draft_scale(width, height, mode, image_format, variants=1):
+    if image_format not in DRAFT_FORMATS:
+        return 1
+    # Chỉ decode JPEG ở 1/2, 1/4, 1/8 khi decode đầy đủ vượt ngân sách bộ nhớ (chấp nhận giảm độ phân giải)
+    scale = 1
+    for candidate in (2, 4, 8):
+        if estimate_render_memory(-(-width // scale), -(-height // scale), mode, variants) <= render_memory_budget:
+            break
+        scale = candidate
+    return scale
+
+async def acquire_render_memory(required):
+    global render_memory_in_use, _render_memory_condition
+    if _render_memory_condition is None:
+        _render_memory_condition = asyncio.Condition()
+
+    def fits():
+        # Ảnh trong cache không còn job nào dùng sẽ bị bỏ trước khi phải xếp hàng
+        global render_memory_in_use
+        if render_memory_in_use + required > render_memory_budget:
+            render_memory_in_use -= evict_idle_sources(render_memory_in_use + required - render_memory_budget)
+        return render_memory_in_use + required <= render_memory_budget
+
+    async with _render_memory_condition:
+        if not fits():
+            render_stats['queued'] += 1
+            logger.info(f"Render queued: needs {required // (1024 * 1024)} MB, {render_memory_in_use // (1024 * 1024)} MB in use")
+        await _render_memory_condition.wait_for(fits)
+        render_memory_in_use += required
+
+async def release_render_memory(required):
+    global render_memory_in_use
+    async with _render_memory_condition:
+        render_memory_in_use -= required
+        _render_memory_condition.notify_all()
+
+async def render_image(input_path, logo_paths, output_path, crop_type='square', logo_positions=None, opacities=None, logo_choice=None):
+    results = await render_image_variants(input_path, [(crop_type, output_path)], logo_paths, logo_positions, opacities, logo_choice)
+    return results[0]
+
+async def render_image_variants(input_path, variants, logo_paths, logo_positions=None, opacities=None, logo_choice=None, cache_source=False, on_source=None):
+    # variants: [(crop_type, output_path), ...] - decode ảnh một lần, render và encode các biến thể song song.
+    # on_source(source) được gọi ngay sau khi decode, trước khi render full-res (dùng cho preview)
+    loop = asyncio.get_running_loop()
     try:
-        logger.info(f"Processing image: input={input_path}, logos={logo_paths}, output={output_path}, crop={crop_type}, positions={logo_positions}, opacities={opacities}, logo_choice={logo_choice}")
-        if not os.path.exists(input_path):
-            logger.error(f"Input image file does not exist: {input_path}")
-            return False, "Input image file does not exist."
-        
-        for logo_path in logo_paths:
-            logger.info(f"Absolute logo path: {os.path.abspath(logo_path)}")
-            if not os.path.exists(logo_path):
-                logger.error(f"Logo file does not exist: {logo_path}")
-                return False, f"Logo file does not exist: {logo_path}"
-        
-        if logo_paths == [] and logo_positions == [] and opacities == [] and logo_choice == 'no_logo':
-            if input_path.lower().endswith('.heic'):
-                logger.info("Detected HEIC file, converting to RGBA")
-                try:
-                    heif_file = pillow_heif.read_heif(input_path)
-                    img = Image.frombytes(
-                        heif_file.mode,
-                        heif_file.size,
-                        heif_file.data,
-                        "raw",
-                        heif_file.mode,
-                        heif_file.stride,
-                    ).convert('RGBA')
-                except Exception as e:
-                    logger.error(f"Error processing HEIC file: {str(e)}")
-                    return False, f"Error processing HEIC file: {str(e)}"
-            else:
-                try:
-                    img = Image.open(input_path).convert('RGBA')
-                except Exception as e:
-                    logger.error(f"Error opening input image: {e}")
-                    return False, f"Error opening input image: {str(e)}"
-            
-            width, height = img.size
-            min_dimension = 1200
-            target_dimension = 1920
-            if crop_type == 'square':
-                new_size = min(width, height)
-                left = (width - new_size) // 2
-                top = (height - new_size) // 2
-                img = img.crop((left, top, left + new_size, top + new_size))
-                if new_size >= target_dimension:
-                    target_size = (target_dimension, target_dimension)
-                else:
-                    target_size = (max(new_size, min_dimension), max(new_size, min_dimension))
-            elif crop_type == '4:5':
-                target_ratio = 4/5
-                if width/height > target_ratio:
-                    new_width = int(height * target_ratio)
-                    left = (width - new_width) // 2
-                    img = img.crop((left, 0, left + new_width, height))
-                    if height >= target_dimension:
-                        new_width = int(target_dimension * target_ratio)
-                        target_size = (new_width, target_dimension)
-                    else:
-                        if height < min_dimension:
-                            new_width = int(min_dimension * target_ratio)
-                            target_size = (new_width, min_dimension)
-                        else:
-                            target_size = (new_width, height)
-                else:
-                    new_height = int(width / target_ratio)
-                    top = (height - new_height) // 2
-                    img = img.crop((0, top, width, top + new_height))
-                    if width >= target_dimension:
-                        new_height = int(target_dimension / target_ratio)
-                        target_size = (target_dimension, new_height)
-                    else:
-                        if width < min_dimension:
-                            new_height = int(min_dimension / target_ratio)
-                            target_size = (min_dimension, new_height)
-                        else:
-                            target_size = (width, new_height)
-            else:
-                if max(width, height) >= target_dimension:
-                    if width > height:
-                        new_width = target_dimension
-                        new_height = int(height * target_dimension / width)
-                    else:
-                        new_height = target_dimension
-                        new_width = int(width * target_dimension / height)
-                    target_size = (new_width, new_height)
-                else:
-                    if max(width, height) < min_dimension:
-                        if width > height:
-                            new_width = min_dimension
-                            new_height = int(height * min_dimension / width)
-                        else:
-                            new_height = min_dimension
-                            new_width = int(width * min_dimension / height)
-                        target_size = (new_width, new_height)
-                    else:
-                        target_size = (width, height)
-            
-            if target_size != img.size:
-                img = img.resize(target_size, Image.LANCZOS)
-            
-            img = img.convert('RGB')
-            logger.info(f"Saving output file as JPG to {output_path} without logo")
-            img.save(output_path, 'JPEG', quality=98, optimize=True)
-            return True, "Image processed successfully without logo."
-        
-        if input_path.lower().endswith('.heic'):
-            logger.info("Detected HEIC file, converting to RGBA")
+        width, height, mode, image_format = await loop.run_in_executor(render_pool, probe_image, input_path)
+    except Exception as e:
+        logger.error(f"Error reading image header: {e}")
+        return [(False, f"Error opening input image: {str(e)}")] * len(variants)
+
+    draft_scale = choose_draft_scale(width, height, mode, image_format, len(variants))
+    required = estimate_render_memory(-(-width // draft_scale), -(-height // draft_scale), mode, len(variants))
+    if required > render_memory_budget:
+        render_stats['rejected'] += 1
+        logger.warning(f"Rejected render of {input_path}: {width}x{height} needs {required // (1024 * 1024)} MB, budget {render_memory_budget // (1024 * 1024)} MB, stats={render_stats}")
+        return [(False, f"Image is too large to process ({width}x{height}).")] * len(variants)
+    if draft_scale > 1:
+        render_stats['downscaled'] += 1
+        logger.info(f"Decoding {input_path} at 1/{draft_scale} scale")
+
+    source_key = (input_path, draft_scale)
+    entry = checkout_source(source_key) if cache_source else None
+    if entry is not None:
+        # Ảnh đã decode nằm trong cache và đã được tính vào bộ nhớ đang dùng
+        required = max(required - entry['bytes'], 0)
+    try:
+        await acquire_render_memory(required)
+    except BaseException:
+        if entry is not None:
+            await release_source(entry)
+        raise
+    render_stats['admitted'] += 1
+    try:
+        error_message = check_render_inputs(input_path, logo_paths)
+        if error_message:
+            return [(False, error_message)] * len(variants)
+        if entry is not None:
+            source = entry['image']
+        else:
             try:
-                heif_file = pillow_heif.read_heif(input_path)
-                img = Image.frombytes(
-                    heif_file.mode,
-                    heif_file.size,
-                    heif_file.data,
-                    "raw",
-                    heif_file.mode,
-                    heif_file.stride,
-                ).convert('RGBA')
+                source, error_message = await loop.run_in_executor(render_pool, decode_source, input_path, draft_scale)
             except Exception as e:
-                logger.error(f"Error processing HEIC file: {str(e)}")
-                return False, f"Error processing HEIC file: {str(e)}"
-        else:
+                logger.error(f"Unknown error processing image: {e}")
+                return [(False, f"Unknown error: {str(e)}")] * len(variants)
+            if source is None:
+                return [(False, error_message)] * len(variants)
+            if cache_source:
+                # Chuyển phần bộ nhớ của bản decode từ job này sang cache
+                entry = await store_source(source_key, source, required)
+                if entry is not None:
+                    required -= entry['bytes']
+        if on_source is not None:
             try:
-                img = Image.open(input_path).convert('RGBA')
+                await on_source(source)
             except Exception as e:
-                logger.error(f"Error opening input image: {e}")
-                return False, f"Error opening input image: {str(e)}"
-        
-        width, height = img.size
-        min_dimension = 1200
-        target_dimension = 1920
-        if crop_type == 'square':
-            new_size = min(width, height)
-            left = (width - new_size) // 2
-            top = (height - new_size) // 2
-            img = img.crop((left, top, left + new_size, top + new_size))
-            if new_size >= target_dimension:
-                target_size = (target_dimension, target_dimension)
+                logger.error(f"Error rendering preview: {e}")
+        return await asyncio.gather(*(
+            loop.run_in_executor(render_pool, functools.partial(
+                render_variant, source, output_path, crop_type, logo_paths, logo_positions, opacities, logo_choice
+            ))
+            for crop_type, output_path in variants
+        ))
+    finally:
+        await release_render_memory(required)
+        if entry is not None:
+            await release_source(entry)
+
+def open_input_image(input_path, draft_scale=1):
+    if is_heif_file(input_path):
+        logger.info("Detected HEIC file, decoding to RGB")
+        try:
+            img = decode_heif(input_path)
+        except Exception as e:
+            logger.error(f"Error processing HEIC file: {str(e)}")
+            return None, f"Error processing HEIC file: {str(e)}"
+    else:
+        try:
+            img = Image.open(input_path)
+            if draft_scale > 1:
+                img.draft(img.mode, (img.width // draft_scale, img.height // draft_scale))
+        except Exception as e:
+            logger.error(f"Error opening input image: {e}")
+            return None, f"Error opening input image: {str(e)}"
+    return img, None
+
+def compute_crop_geometry(width, height, crop_type):
+    min_dimension = 1200
+    target_dimension = 1920
+    crop_box = (0, 0, width, height)
+    if crop_type == 'square':
+        new_size = min(width, height)
+        left = (width - new_size) // 2
+        top = (height - new_size) // 2
+        crop_box = (left, top, left + new_size, top + new_size)
+        if new_size >= target_dimension:
+            target_size = (target_dimension, target_dimension)
+        else:
+            target_size = (max(new_size, min_dimension), max(new_size, min_dimension))
+    elif crop_type == '4:5':
+        target_ratio = 4/5
+        if width/height > target_ratio:
+            new_width = int(height * target_ratio)
+            left = (width - new_width) // 2
+            crop_box = (left, 0, left + new_width, height)
+            if height >= target_dimension:
+                new_width = int(target_dimension * target_ratio)
+                target_size = (new_width, target_dimension)
             else:
-                target_size = (max(new_size, min_dimension), max(new_size, min_dimension))
-        elif crop_type == '4:5':
-            target_ratio = 4/5
-            if width/height > target_ratio:
-                new_width = int(height * target_ratio)
-                left = (width - new_width) // 2
-                img = img.crop((left, 0, left + new_width, height))
-                if height >= target_dimension:
-                    new_width = int(target_dimension * target_ratio)
-                    target_size = (new_width, target_dimension)
+                if height < min_dimension:
+                    new_width = int(min_dimension * target_ratio)
+                    target_size = (new_width, min_dimension)
                 else:
-                    if height < min_dimension:
-                        new_width = int(min_dimension * target_ratio)
-                        target_size = (new_width, min_dimension)
-                    else:
-                        target_size = (new_width, height)
+                    target_size = (new_width, height)
+        else:
+            new_height = int(width / target_ratio)
+            top = (height - new_height) // 2
+            crop_box = (0, top, width, top + new_height)
+            if width >= target_dimension:
+                new_height = int(target_dimension / target_ratio)
+                target_size = (target_dimension, new_height)
             else:
-                new_height = int(width / target_ratio)
-                top = (height - new_height) // 2
-                img = img.crop((0, top, width, top + new_height))
-                if width >= target_dimension:
-                    new_height = int(target_dimension / target_ratio)
-                    target_size = (target_dimension, new_height)
+                if width < min_dimension:
+                    new_height = int(min_dimension / target_ratio)
+                    target_size = (min_dimension, new_height)
                 else:
-                    if width < min_dimension:
-                        new_height = int(min_dimension / target_ratio)
-                        target_size = (min_dimension, new_height)
-                    else:
-                        target_size = (width, new_height)
+                    target_size = (width, new_height)
+    else:
+        if max(width, height) >= target_dimension:
+            if width > height:
+                new_width = target_dimension
+                new_height = int(height * target_dimension / width)
+            else:
+                new_height = target_dimension
+                new_width = int(width * target_dimension / height)
+            target_size = (new_width, new_height)
         else:
-            if max(width, height) >= target_dimension:
+            if max(width, height) < min_dimension:
                 if width > height:
-                    new_width = target_dimension
-                    new_height = int(height * target_dimension / width)
+                    new_width = min_dimension
+                    new_height = int(height * min_dimension / width)
                 else:
-                    new_height = target_dimension
-                    new_width = int(width * target_dimension / height)
+                    new_height = min_dimension
+                    new_width = int(width * min_dimension / height)
                 target_size = (new_width, new_height)
             else:
-                if max(width, height) < min_dimension:
-                    if width > height:
-                        new_width = min_dimension
-                        new_height = int(height * min_dimension / width)
-                    else:
-                        new_height = min_dimension
-                        new_width = int(width * min_dimension / height)
-                    target_size = (new_width, new_height)
-                else:
-                    target_size = (width, height)
+                target_size = (width, height)
+    return crop_box, target_size
+
+def resize_in_strips(img, crop_box, target_size):
+    # Resample từng dải ngang trực tiếp từ ảnh gốc (dùng box thay cho crop),
+    # không tạo bản RGBA/crop toàn khung. Hệ số Lanczos giống hệt đường thường,
+    # sai khác chỉ do làm tròn số thực (giới hạn ở TILED_MAX_PIXEL_DIFF, kiểm tra bằng check-strips).
+    left, top, right, bottom = crop_box
+    target_width, target_height = target_size
+    scale_y = (bottom - top) / target_height
+    support = 3 * max(scale_y, 1.0) + 1  # Bán kính Lanczos (a=3) tính theo pixel nguồn
+    output = Image.new(img.mode, target_size)
+    for y in range(0, target_height, TILE_STRIP_HEIGHT):
+        strip_height = min(TILE_STRIP_HEIGHT, target_height - y)
+        source_top = top + y * scale_y
+        source_bottom = top + (y + strip_height) * scale_y
+        rows_top = max(top, int(source_top - support))
+        rows_bottom = min(bottom, int(source_bottom + support) + 1)
+        rows = img.crop((left, rows_top, right, rows_bottom))
+        box = (0, source_top - rows_top, right - left, source_bottom - rows_top)
+        output.paste(rows.resize((target_width, strip_height), Image.LANCZOS, box=box), (0, y))
+    return output
+
+# Cache ảnh đã decode để render lại (đổi vị trí logo sau preview) không phải decode lại.
+# Dung lượng cache được tính vào render_memory_in_use; chỉ truy cập từ event loop.
+# Mỗi entry: {'image', 'bytes', 'users': số job đang dùng, 'cached': còn nằm trong cache}
+_source_cache = OrderedDict()
+source_cache_bytes = 0
+
+def checkout_source(key):
+    entry = _source_cache.get(key)
+    if entry is not None:
+        _source_cache.move_to_end(key)
+        entry['users'] += 1
+    return entry
+
+def evict_idle_sources(needed):
+    # Bỏ các ảnh không có job nào dùng (cũ nhất trước) đến khi đủ needed byte, trả về số byte đã bỏ
+    global source_cache_bytes
+    freed = 0
+    for key in list(_source_cache):
+        if freed >= needed:
+            break
+        entry = _source_cache[key]
+        if entry['users'] == 0:
+            del _source_cache[key]
+            entry['cached'] = False
+            source_cache_bytes -= entry['bytes']
+            freed += entry['bytes']
+    return freed
+
+async def store_source(key, source, reserved):
+    global source_cache_bytes
+    if key in _source_cache:
+        return None
+    entry = {
+        'image': source,
+        'bytes': min(source.width * source.height * mode_bands(source.mode), reserved),
+        'users': 1,
+        'cached': True,
+    }
+    _source_cache[key] = entry
+    source_cache_bytes += entry['bytes']
+    # Giới hạn theo dung lượng: tối đa 1/4 ngân sách bộ nhớ render
+    freed = evict_idle_sources(source_cache_bytes - render_memory_budget // 4)
+    if freed:
+        await release_render_memory(freed)
+    return entry
+
+async def release_source(entry):
+    entry['users'] -= 1
+    # Entry bị bỏ khỏi cache trong lúc job còn dùng: trả bộ nhớ khi job cuối cùng xong
+    await release_render_memory(entry['bytes'] if entry['users'] == 0 and not entry['cached'] else 0)
+
+def drop_sources(path_prefix):
+    global source_cache_bytes
+    freed = 0
+    for key in [key for key in _source_cache if key[0].startswith(path_prefix)]:
+        entry = _source_cache.pop(key)
+        entry['cached'] = False
+        source_cache_bytes -= entry['bytes']
+        if entry['users'] == 0:
+            freed += entry['bytes']
+    if freed:
+        asyncio.get_running_loop().create_task(release_render_memory(freed))
+
+def decode_source(input_path, draft_scale=1):
+    # Decode toàn bộ pixel một lần; ảnh trả về chỉ được đọc, có thể dùng chung cho nhiều biến thể
+    img, error_message = open_input_image(input_path, draft_scale)
+    if img is None:
+        return None, error_message
+    if img.mode not in TILEABLE_MODES:
+        img = img.convert('RGBA')
+    img.load()
+    return img, None
+
+def resize_source(img, crop_type):
+    crop_box, target_size = compute_crop_geometry(img.width, img.height, crop_type)
+    if use_tiled_path(img.width, img.height, img.mode):
+        logger.info(f"Large image {img.width}x{img.height}, resizing in strips of {TILE_STRIP_HEIGHT} rows")
+        return resize_in_strips(img, crop_box, target_size).convert('RGBA')
+    # RGB/L được crop và resize ở mode gốc, chỉ convert sang RGBA ở kích thước đầu ra
+    if crop_box != (0, 0, img.width, img.height):
+        img = img.crop(crop_box)
+    if target_size != img.size:
+        img = img.resize(target_size, Image.LANCZOS)
+    return img.convert('RGBA')
+
+def render_preview(source, crop_type, logo_paths, logo_positions=None, opacities=None):
+    # Preview nhỏ (cạnh dài PREVIEW_SIZE): reduce() thẳng trên vùng crop, logo tính theo kích thước preview
+    crop_box, target_size = compute_crop_geometry(source.width, source.height, crop_type)
+    scale = min(1.0, PREVIEW_SIZE / max(target_size))
+    preview_size = (max(1, round(target_size[0] * scale)), max(1, round(target_size[1] * scale)))
+    factor = max(1, min((crop_box[2] - crop_box[0]) // preview_size[0], (crop_box[3] - crop_box[1]) // preview_size[1]))
+    img = source.reduce(factor, box=crop_box)
+    if img.size != preview_size:
+        img = img.resize(preview_size, Image.BILINEAR)
+    img = img.convert('RGBA')
+    logo_specs = tuple(zip(logo_paths, logo_positions or [], opacities or [1.0]*len(logo_paths)))
+    if logo_specs:
+        for overlay, paste_position in get_logo_set_overlay(logo_specs, img.size):
+            img.paste(overlay, paste_position, overlay)
+    buffer = io.BytesIO()
+    img.convert('RGB').save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+def build_logo_job(logo_choice, position, opacity):
+    # Trả về (logo_paths, logo_positions, opacities) cho process_image
+    if logo_choice == 'no_logo':
+        return [], [], []
+    return [logo_registry[logo_choice]['path']], [position], [opacity]
+
+def unique_output_filename(base_name, used_names):
+    # Trùng tên thì thêm số đếm đến khi có tên chưa dùng (dùng chung cho /render và batch)
+    output_filename = f"{base_name}_edit.jpg"
+    counter = 1
+    while output_filename in used_names:
+        output_filename = f"{base_name}_{counter}_edit.jpg"
+        counter += 1
+    used_names.add(output_filename)
+    return output_filename
+
+def check_render_inputs(input_path, logo_paths):
+    if not os.path.exists(input_path):
+        logger.error(f"Input image file does not exist: {input_path}")
+        return "Input image file does not exist."
+    for logo_path in logo_paths:
+        logger.info(f"Absolute logo path: {os.path.abspath(logo_path)}")
+        if not os.path.exists(logo_path):
+            logger.error(f"Logo file does not exist: {logo_path}")
+            return f"Logo file does not exist: {logo_path}"
+    return None
+
+# Xử lý một ảnh đồng bộ (batch CLI): kiểm tra đầu vào, decode, render một biến thể
+def process_image(input_path, logo_paths, output_path, crop_type='square', logo_positions=None, opacities=None, logo_choice=None, draft_scale=1):
+    try:
+        load_codecs()
+        logger.info(f"Processing image: input={input_path}, logos={logo_paths}, output={output_path}, crop={crop_type}, positions={logo_positions}, opacities={opacities}, logo_choice={logo_choice}")
+        error_message = check_render_inputs(input_path, logo_paths)
+        if error_message:
+            return False, error_message
         
-        if target_size != img.size:
-            img = img.resize(target_size, Image.LANCZOS)
+        source, error_message = decode_source(input_path, draft_scale)
+        if source is None:
+            return False, error_message
+    except Exception as e:
+        logger.error(f"Unknown error processing image: {e}")
+        return False, f"Unknown error: {str(e)}"
+    return render_variant(source, output_path, crop_type, logo_paths, logo_positions, opacities, logo_choice)
+
+def render_variant(source, output_path, crop_type, logo_paths, logo_positions=None, opacities=None, logo_choice=None):
+    try:
+        logger.info(f"Rendering {crop_type} variant to {output_path}")
+        img = resize_source(source, crop_type)
+        
+        if logo_paths == [] and logo_positions == [] and opacities == [] and logo_choice == 'no_logo':
+            img = img.convert('RGB')
+            logger.info(f"Saving output file as JPG to {output_path} without logo")
+            img.save(output_path, 'JPEG', quality=98, optimize=True)
+            return True, "Image processed successfully without logo."
         
         try:
-            img_area = target_size[0] * target_size[1]
-            
-            for logo_path, logo_position, opacity in zip(logo_paths, logo_positions, opacities or [1.0]*len(logo_paths)):
-                logo = Image.open(logo_path).convert('RGBA')
-                
-                if 'kenh14.png' in logo_path:
-                    target_logo_area = img_area * 0.035
-                elif 'AI.png' in logo_path:
-                    target_logo_area = img_area * 0.025
-                elif 'gd.png' in logo_path:
-                    target_logo_area = img_area * 0.012
-                else:
-                    target_logo_area = img_area * 0.036
-                
-                logger.info(f"Logo: {logo_path}, Target Area: {target_logo_area}, Position: {logo_position}")
-                
-                scale_factor = (target_logo_area / (logo.width * logo.height)) ** 0.5
-                logo_width = int(logo.width * scale_factor)
-                logo_height = int(logo.height * scale_factor)
-                logo = logo.resize((logo_width, logo_height), Image.LANCZOS)
-                
-                if opacity < 1.0:
-                    alpha = logo.split()[3]
-                    alpha = ImageEnhance.Brightness(alpha).enhance(opacity)
-                    logo.putalpha(alpha)
-                
-                img_width, img_height = img.size
-                if logo_position == 'top-left':
-                    paste_position = (0, 0)
-                elif logo_position == 'top-right':
-                    paste_position = (img_width - logo_width, 0)
-                elif logo_position == 'bottom-left':
-                    paste_position = (0, img_height - logo_height)
-                elif logo_position == 'bottom-right':
-                    paste_position = (img_width - logo_width, img_height - logo_height)
-                elif logo_position == 'center':
-                    paste_position = ((img_width - logo_width) // 2, (img_height - logo_height) // 2)
-                elif logo_position == 'middle-top':
-                    paste_position = ((img_width - logo_width) // 2, 0)
-                elif logo_position == 'middle-bottom':
-                    paste_position = ((img_width - logo_width) // 2, img_height - logo_height)
-                else:
-                    paste_position = (0, 0)
-                
-                logger.info(f"Pasting logo at position: {paste_position}")
-                img.paste(logo, paste_position, logo)
+            logo_specs = tuple(zip(logo_paths, logo_positions, opacities or [1.0]*len(logo_paths)))
+            pastes = get_logo_set_overlay(logo_specs, img.size)
+            logger.info(f"Pasting {len(logo_specs)} logos at positions: {logo_positions} as {len(pastes)} overlays at {[position for _, position in pastes]}")
+            for overlay, paste_position in pastes:
+                img.paste(overlay, paste_position, overlay)
         except Exception as e:
             logger.error(f"Error processing logo: {e}")
             return False, f"Error processing logo: {str(e)}"
@@ -299,11 +771,257 @@ def process_image(input_path, logo_paths, output_path, crop_type='square', logo_
         logger.error(f"Unknown error processing image: {e}")
         return False, f"Unknown error: {str(e)}"
 
+# HTTP render API cho client ngoài Telegram (CMS), dùng chung render pool và ngân sách bộ nhớ
+RENDER_API_MAX_FILES = 50
+RENDER_API_MAX_FILE_BYTES = 30 * 1024 * 1024
+RENDER_API_MAX_REQUEST_BYTES = 200 * 1024 * 1024
+RENDER_API_MAX_CONCURRENT = 4
+render_api_active = 0
+
+class RenderRequestLimiter:
+    # ASGI middleware cho POST /render: giữ chỗ trước khi đọc body multipart, đếm byte trong lúc nhận
+    # (kể cả upload chunked), trả chỗ và xóa temp dir khi request kết thúc, kể cả khi client ngắt kết nối
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        global render_api_active
+        if scope['type'] != 'http' or scope['path'] != '/render' or scope['method'] != 'POST':
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope['headers']).get(b'content-length', b'')
+        if content_length.isdigit() and int(content_length) > RENDER_API_MAX_REQUEST_BYTES:
+            await JSONResponse({"status": "error", "message": "Request too large"}, status_code=413)(scope, receive, send)
+            return
+        if render_api_active >= RENDER_API_MAX_CONCURRENT:
+            await JSONResponse({"status": "error", "message": "Too many concurrent renders"}, status_code=429)(scope, receive, send)
+            return
+
+        render_api_active += 1
+        received = 0
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > RENDER_API_MAX_REQUEST_BYTES:
+                    raise HTTPException(status_code=413, detail="Request too large")
+            return message
+
+        async def tracking_send(message):
+            nonlocal response_started
+            if message['type'] == 'http.response.start':
+                response_started = True
+            await send(message)
+
+        state = scope.setdefault('state', {})
+        try:
+            await self.app(scope, limited_receive, tracking_send)
+        except HTTPException as e:
+            if response_started:
+                raise
+            await JSONResponse({"status": "error", "message": e.detail}, status_code=e.status_code)(scope, receive, send)
+        finally:
+            render_api_active -= 1
+            if state.get('render_temp_dir'):
+                shutil.rmtree(state['render_temp_dir'], ignore_errors=True)
+
+app.add_middleware(RenderRequestLimiter)
+
+class ZipStream:
+    # File-like không seek được: zipfile ghi vào, generator lấy ra từng phần để stream
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def save_upload(upload_file, input_path):
+    with open(input_path, 'wb') as f:
+        shutil.copyfileobj(upload_file, f)
+
+def client_render_error(error_message, job):
+    # Không để lộ đường dẫn temp của server trong phản hồi, dùng tên file client gửi lên
+    input_path, output_path, output_filename, client_name = job
+    return error_message.replace(input_path, client_name).replace(output_path, output_filename)
+
+async def stream_render_zip(jobs, logo_paths, logo_positions, opacities, crop, logo):
+    async def render_job(job):
+        input_path, output_path, output_filename, client_name = job
+        result = await render_image(input_path, logo_paths, output_path, crop, logo_positions, opacities, logo_choice=logo)
+        return job, result
+
+    loop = asyncio.get_running_loop()
+    stream = ZipStream()
+    errors = []
+    tasks = [asyncio.create_task(render_job(job)) for job in jobs]
+    try:
+        with zipfile.ZipFile(stream, 'w', zipfile.ZIP_STORED) as archive:
+            for task in asyncio.as_completed(tasks):
+                job, (success, error_message) = await task
+                input_path, output_path, output_filename, client_name = job
+                if success:
+                    # Đọc file kết quả ngoài event loop (dùng chung với webhook Telegram)
+                    await loop.run_in_executor(None, archive.write, output_path, output_filename)
+                    os.remove(output_path)
+                else:
+                    errors.append(f"{output_filename}: {client_render_error(error_message, job)}")
+                yield stream.pop()
+            if errors:
+                archive.writestr('errors.txt', "\n".join(errors) + "\n")
+        yield stream.pop()
+    finally:
+        # Client ngắt kết nối giữa chừng: hủy các job chưa xong để trả bộ nhớ render
+        for task in tasks:
+            task.cancel()
+
+@app.post("/render")
+async def render(
+    request: Request,
+    files: List[UploadFile] = File(...),
+    crop: str = Form('square'),
+    logo: str = Form('kenh14'),
+    position: str = Form('top-left'),
+    opacity: float = Form(1.0),
+):
+    if crop not in ('square', '4:5', 'keep'):
+        raise HTTPException(status_code=400, detail=f"Invalid crop: {crop}")
+    if logo not in LOGO_CHOICES + ['no_logo']:
+        raise HTTPException(status_code=400, detail=f"Invalid logo: {logo}")
+    if position not in (logo_registry[logo]['positions'] if logo in logo_registry else LOGO_POSITIONS):
+        raise HTTPException(status_code=400, detail=f"Invalid position: {position}")
+    if not 0 < opacity <= 1:
+        raise HTTPException(status_code=400, detail=f"Invalid opacity: {opacity}")
+    if not files or len(files) > RENDER_API_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"Send between 1 and {RENDER_API_MAX_FILES} files")
+
+    # Temp dir được RenderRequestLimiter xóa khi request kết thúc
+    temp_dir = tempfile.mkdtemp()
+    request.state.render_temp_dir = temp_dir
+    jobs = []
+    used_names = set()
+    for index, upload in enumerate(files):
+        if upload.size is not None and upload.size > RENDER_API_MAX_FILE_BYTES:
+            raise HTTPException(status_code=413, detail=f"{upload.filename} is too large (max 30MB)")
+        base_name = os.path.splitext(os.path.basename(upload.filename or ''))[0] or f"image_{index}"
+        output_filename = unique_output_filename(base_name, used_names)
+        input_path = os.path.join(temp_dir, f"input_{index}")
+        await asyncio.get_running_loop().run_in_executor(None, save_upload, upload.file, input_path)
+        jobs.append((input_path, os.path.join(temp_dir, output_filename), output_filename, upload.filename or base_name))
+
+    logo_paths, logo_positions, opacities = build_logo_job(logo, position, opacity)
+    logger.info(f"Render API: {len(jobs)} files, crop={crop}, logo={logo}, position={position}, opacity={opacity}")
+
+    if len(jobs) == 1:
+        input_path, output_path, output_filename, client_name = jobs[0]
+        success, error_message = await render_image(input_path, logo_paths, output_path, crop, logo_positions, opacities, logo_choice=logo)
+        if not success:
+            return JSONResponse({"status": "error", "message": client_render_error(error_message, jobs[0])}, status_code=422)
+        return FileResponse(output_path, media_type='image/jpeg', filename=output_filename)
+
+    return StreamingResponse(
+        stream_render_zip(jobs, logo_paths, logo_positions, opacities, crop, logo),
+        media_type='application/zip',
+        headers={"Content-Disposition": 'attachment; filename="render.zip"'},
+    )
+
+# Preset theo chat lưu trong SQLite: khi có preset, ảnh gửi đến được xử lý ngay không qua menu
+PRESET_DB_PATH = os.environ.get('PRESET_DB_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'presets.db'))
+_preset_cache = {}
+
+def init_preset_db():
+    with sqlite3.connect(PRESET_DB_PATH) as db:
+        db.execute("CREATE TABLE IF NOT EXISTS presets (chat_id INTEGER PRIMARY KEY, selection TEXT NOT NULL, updated_at REAL NOT NULL)")
+
+def get_preset(chat_id):
+    if chat_id not in _preset_cache:
+        with sqlite3.connect(PRESET_DB_PATH) as db:
+            row = db.execute("SELECT selection FROM presets WHERE chat_id = ?", (chat_id,)).fetchone()
+        preset = json.loads(row[0]) if row else None
+        # Preset không có logo hoặc trỏ tới logo/vị trí đã bị xóa khỏi registry thì bỏ qua
+        if preset and (not preset['logos'] or not all(
+            logo['logo_choice'] in logo_registry and logo['position'] in logo_registry[logo['logo_choice']]['positions']
+            for logo in preset['logos']
+        )):
+            logger.warning(f"Ignoring outdated preset for chat_id={chat_id}: {preset}")
+            preset = None
+        _preset_cache[chat_id] = preset
+    return _preset_cache[chat_id]
+
+def save_preset(chat_id, selection):
+    if not selection['logos']:
+        return False
+    # Bản sao riêng: không dùng chung list logos với nhóm ảnh đang xử lý
+    selection = copy.deepcopy(selection)
+    with sqlite3.connect(PRESET_DB_PATH) as db:
+        db.execute(
+            "INSERT OR REPLACE INTO presets (chat_id, selection, updated_at) VALUES (?, ?, ?)",
+            (chat_id, json.dumps(selection, ensure_ascii=False), time.time())
+        )
+    _preset_cache[chat_id] = selection
+    return True
+
+def delete_preset(chat_id):
+    with sqlite3.connect(PRESET_DB_PATH) as db:
+        db.execute("DELETE FROM presets WHERE chat_id = ?", (chat_id,))
+    _preset_cache[chat_id] = None
+
+def describe_selection(selection):
+    logos = selection['logos']
+    if len(logos) == 1:
+        return f"- {selection['crop_display']}\n- {logos[0]['logo_display']}\n- {logos[0]['position_display']}"
+    return f"- {selection['crop_display']}\n" + "\n".join(
+        f"- {logo['logo_display']}: {logo['position_display']}" for logo in logos
+    )
+
 # Các hàm xử lý Telegram
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "Tôi là AI chỉnh sửa ảnh. Hãy gửi hoặc chuyển tiếp ảnh, tôi sẽ xử lý theo yêu cầu của bạn!\n"
-        "Bạn sẽ được chọn cách crop ảnh và loại logo để thêm vào."
+        "Bạn sẽ được chọn cách crop ảnh và loại logo để thêm vào.\n"
+        "Dùng /preset để lưu lựa chọn và bỏ qua các bước chọn."
+    )
+
+async def preset_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    action = context.args[0].lower() if context.args else ''
+    
+    if action == 'save':
+        selection = context.chat_data.get('last_selection')
+        if not selection:
+            await update.message.reply_text("Chưa có lựa chọn nào để lưu. Hãy xử lý một ảnh trước rồi dùng /preset save.")
+            return
+        if not save_preset(chat_id, selection):
+            await update.message.reply_text("Lựa chọn gần nhất không có logo, không thể lưu làm preset.")
+            return
+        logger.info(f"Saved preset for chat_id={chat_id}: {selection}")
+        await update.message.reply_text("Đã lưu preset, ảnh gửi đến sẽ được xử lý ngay:\n" + describe_selection(selection))
+        return
+    
+    if action == 'off':
+        delete_preset(chat_id)
+        logger.info(f"Deleted preset for chat_id={chat_id}")
+        await update.message.reply_text("Đã tắt preset, bạn sẽ được chọn lại cho mỗi lần gửi ảnh.")
+        return
+    
+    preset = get_preset(chat_id)
+    current = "Preset hiện tại:\n" + describe_selection(preset) if preset else "Chưa có preset."
+    await update.message.reply_text(
+        f"{current}\n\n"
+        "/preset save - lưu lựa chọn của lần xử lý gần nhất\n"
+        "/preset off - tắt preset"
     )
 
 def initialize_temp_dir(context):
@@ -314,15 +1032,33 @@ def initialize_temp_dir(context):
         shutil.rmtree(context.user_data['temp_dir'], ignore_errors=True)
     context.user_data['temp_dir'] = tempfile.mkdtemp()
 
-async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    start_time = time.time()
-    message = update.message
-    
+def initialize_media_state(context):
     if 'media_groups' not in context.user_data:
         context.user_data['media_groups'] = {}
         context.user_data['last_media_time'] = 0
         context.user_data['current_group_id'] = None
         initialize_temp_dir(context)
+
+def new_image_entry(message, temp_dir, file, file_name, base_name):
+    return {
+        'file': file,
+        'file_name': file_name,
+        'base_name': base_name,
+        # Tiền tố message_id để các ảnh cùng tên trong một album không ghi đè nhau khi render song song
+        'input_path': os.path.join(temp_dir, f"{message.message_id}_{file_name}"),
+        'output_filename': f"{base_name}_edit.jpg",
+        'output_path': os.path.join(temp_dir, f"{message.message_id}_{base_name}_edit.jpg")
+    }
+
+async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    start_time = time.time()
+    message = update.message
+    
+    # Ảnh mới đến: kết thúc các nhóm đang chờ xác nhận preview (ảnh full-res đã được gửi)
+    for old_group_id in [gid for gid, g in context.user_data.get('media_groups', {}).items() if g.get('reviewing')]:
+        finish_group(context, old_group_id)
+    
+    initialize_media_state(context)
     
     temp_dir = context.user_data['temp_dir']
     file = None
@@ -354,6 +1090,25 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await message.reply_text("File ảnh quá lớn (tối đa 30MB)!")
         return
 
+    preset = get_preset(message.chat_id)
+    if preset:
+        # Mỗi ảnh là một job riêng, render ngay khi đến
+        initialize_media_state(context)
+        group_id = f"preset{message.message_id}"
+        context.user_data['media_groups'][group_id] = {
+            'images': [new_image_entry(message, context.user_data['temp_dir'], file, file_name, base_name)],
+            'chat_id': message.chat_id,
+            'crop_asked': True,
+            'logo_asked': True,
+            'processed': False,
+            'crop_type': preset['crop_type'],
+            'crop_display': preset['crop_display'],
+            'logos': [dict(logo) for logo in preset['logos']],
+        }
+        logger.info(f"Processing image with preset for chat_id={message.chat_id}, group_id={group_id}")
+        await process_group(message, context, group_id, interactive=False)
+        return
+
     current_time = time.time()
     if current_time - context.user_data['last_media_time'] > 5 or context.user_data['current_group_id'] is None:
         context.user_data['current_group_id'] = str(current_time)
@@ -368,14 +1123,7 @@ async def handle_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
     group_id = context.user_data['current_group_id']
     context.user_data['last_media_time'] = current_time
 
-    context.user_data['media_groups'][group_id]['images'].append({
-        'file': file,
-        'file_name': file_name,
-        'base_name': base_name,
-        'input_path': os.path.join(temp_dir, file_name),
-        'output_filename': f"{base_name}_edit.jpg",
-        'output_path': os.path.join(temp_dir, f"{base_name}_edit.jpg")
-    })
+    context.user_data['media_groups'][group_id]['images'].append(new_image_entry(message, temp_dir, file, file_name, base_name))
     
     logger.info(f"Added image to group_id={group_id}, total images: {len(context.user_data['media_groups'][group_id]['images'])}")
     
@@ -387,7 +1135,8 @@ async def ask_for_crop(bot, chat_id, group_id):
     keyboard = [
         [InlineKeyboardButton("Ảnh vuông (Facebook)", callback_data=f"crop_square_{group_id}")],
         [InlineKeyboardButton("Ảnh tỉ lệ 4:5 (Instagram)", callback_data=f"crop_4:5_{group_id}")],
-        [InlineKeyboardButton("Giữ nguyên tỉ lệ ảnh", callback_data=f"crop_keep_{group_id}")]
+        [InlineKeyboardButton("Giữ nguyên tỉ lệ ảnh", callback_data=f"crop_keep_{group_id}")],
+        [InlineKeyboardButton("Tất cả định dạng (vuông, 4:5, gốc)", callback_data=f"crop_all_{group_id}")]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
@@ -397,13 +1146,13 @@ async def ask_for_crop(bot, chat_id, group_id):
         reply_markup=reply_markup
     )
 
-async def ask_for_logo(bot, chat_id, group_id, include_back=False):
+async def ask_for_logo(bot, chat_id, group_id, include_back=False, include_multi=True):
     keyboard = [
-        [InlineKeyboardButton("Logo Đi soi sao đi", callback_data=f"logo_disoi_{group_id}")],
-        [InlineKeyboardButton("Logo Kenh14", callback_data=f"logo_kenh14_{group_id}")],
-        [InlineKeyboardButton("Logo G-Dragon x K14", callback_data=f"logo_gd_{group_id}")],
-        [InlineKeyboardButton("Logo \"ảnh tạo bởi AI\"", callback_data=f"logo_ai_{group_id}")]
+        [InlineKeyboardButton(entry['name'], callback_data=f"logo_{entry['id']}_{group_id}")]
+        for entry in logo_registry.values()
     ]
+    if include_multi:
+        keyboard.append([InlineKeyboardButton("Kết hợp nhiều logo", callback_data=f"logo_multi_{group_id}")])
     if include_back:
         keyboard.append([InlineKeyboardButton("Quay về", callback_data=f"back_to_crop_{group_id}")])
     
@@ -415,15 +1164,22 @@ async def ask_for_logo(bot, chat_id, group_id, include_back=False):
         reply_markup=reply_markup
     )
 
+async def ask_for_more_logos(bot, chat_id, group_id, logo_count):
+    keyboard = [
+        [InlineKeyboardButton("Thêm logo khác", callback_data=f"more_add_{group_id}")],
+        [InlineKeyboardButton("Xử lý ảnh", callback_data=f"more_done_{group_id}")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await bot.send_message(
+        chat_id=chat_id,
+        text=f"ĐÃ CHỌN {logo_count} LOGO. THÊM LOGO KHÁC?",
+        reply_markup=reply_markup
+    )
+
 async def ask_for_position(bot, chat_id, group_id, logo_type, include_back=False):
     keyboard = [
-        [InlineKeyboardButton("Góc trên - trái", callback_data=f"pos_top-left_{group_id}_{logo_type}.png")],
-        [InlineKeyboardButton("Góc trên - phải", callback_data=f"pos_top-right_{group_id}_{logo_type}.png")],
-        [InlineKeyboardButton("Góc dưới - trái", callback_data=f"pos_bottom-left_{group_id}_{logo_type}.png")],
-        [InlineKeyboardButton("Góc dưới - phải", callback_data=f"pos_bottom-right_{group_id}_{logo_type}.png")],
-        [InlineKeyboardButton("Ở giữa ảnh - độ mờ tùy chỉnh", callback_data=f"pos_center_{group_id}_{logo_type}.png")],
-        [InlineKeyboardButton("Giữa - Phía trên", callback_data=f"pos_middle-top_{group_id}_{logo_type}.png")],
-        [InlineKeyboardButton("Giữa - Phía dưới", callback_data=f"pos_middle-bottom_{group_id}_{logo_type}.png")]
+        [InlineKeyboardButton(POSITION_LABELS[position], callback_data=f"pos_{position}_{group_id}_{logo_type}.png")]
+        for position in logo_registry[logo_type]['positions']
     ]
     
     if include_back:
@@ -483,10 +1239,11 @@ async def handle_crop_selection(update: Update, context: ContextTypes.DEFAULT_TY
     except BadRequest:
         logger.debug("Cannot delete crop selection message.")
     
-    context.user_data['media_groups'][group_id]['crop_type'] = 'square' if crop_type == 'square' else '4:5' if crop_type == '4:5' else 'keep'
+    context.user_data['media_groups'][group_id]['crop_type'] = 'square' if crop_type == 'square' else '4:5' if crop_type == '4:5' else 'all' if crop_type == 'all' else 'keep'
     context.user_data['media_groups'][group_id]['crop_display'] = (
         "Ảnh vuông (Facebook)" if crop_type == 'square' else
         "Ảnh tỉ lệ 4:5 (Instagram)" if crop_type == '4:5' else
+        "Tất cả định dạng (vuông, 4:5, gốc)" if crop_type == 'all' else
         "Giữ nguyên tỉ lệ ảnh"
     )
     
@@ -534,19 +1291,24 @@ async def handle_logo_selection(update: Update, context: ContextTypes.DEFAULT_TY
         context.user_data['media_groups'][group_id]['logo_choice'] = None
         context.user_data['media_groups'][group_id]['logo_display'] = None
         context.user_data['media_groups'][group_id]['logo_asked'] = False
+        # Chọn lại từ đầu: bỏ các logo đã đặt trong chế độ nhiều logo
+        context.user_data['media_groups'][group_id]['logos'] = []
+        context.user_data['media_groups'][group_id]['multi_logo'] = False
         await ask_for_crop(context.bot, context.user_data['media_groups'][group_id]['chat_id'], group_id)
         return
     
+    if action == 'logo' and callback_data[1] == 'multi':
+        logger.info(f"User selected multiple logos for group_id={group_id}")
+        context.user_data['media_groups'][group_id]['multi_logo'] = True
+        await ask_for_logo(context.bot, context.user_data['media_groups'][group_id]['chat_id'], group_id, include_back=True, include_multi=False)
+        return
+    
     if action == 'logo':
         logo_choice = callback_data[1]
         logger.info(f"User selected logo {logo_choice} for group_id={group_id}")
         context.user_data['media_groups'][group_id]['logo_choice'] = logo_choice
         context.user_data['media_groups'][group_id]['logo_display'] = (
-            "Logo Đi soi sao đi" if logo_choice == 'disoi' else
-            "Logo Kenh14" if logo_choice == 'kenh14' else
-            "Logo \"ảnh tạo bởi AI\"" if logo_choice == 'ai' else
-            "Logo G-Dragon x K14" if logo_choice == 'gd' else 
-            "Unknown logo"
+            logo_registry[logo_choice]['name'] if logo_choice in logo_registry else "Unknown logo"
         )
         
         logger.info(f"Asking for position selection for group_id={group_id}, logo={logo_choice}")
@@ -610,7 +1372,7 @@ async def handle_position_selection(update: Update, context: ContextTypes.DEFAUL
             logger.debug("Cannot delete position selection message.")
         
         context.user_data['media_groups'][group_id]['position'] = 'center'
-        context.user_data['media_groups'][group_id]['position_display'] = "Ở giữa ảnh - độ mờ tùy chỉnh"
+        context.user_data['media_groups'][group_id]['position_display'] = POSITION_LABELS['center']
         
         logger.info(f"Asking for opacity selection for group_id={group_id}, logo={logo_type}")
         await ask_for_opacity(context.bot, context.user_data['media_groups'][group_id]['chat_id'], group_id, logo_type, include_back=True)
@@ -637,83 +1399,7 @@ async def handle_position_selection(update: Update, context: ContextTypes.DEFAUL
             logger.debug("Cannot delete opacity selection message.")
         
         position = context.user_data['media_groups'][group_id]['position']
-        logo_choice = context.user_data['media_groups'][group_id]['logo_choice']
-        logger.info(f"Selected logo_choice: {logo_choice}, position: {position}, opacity: {opacity} for group_id={group_id}")
-        
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        logo_path = os.path.join(script_dir, 'Logo', f"{logo_choice}.png")
-        logo_paths = [logo_path]
-        logo_positions = [position]
-        opacities = [opacity]
-        
-        position_display = f"Ở giữa - mờ {int(opacity * 100)}%"
-        context.user_data['media_groups'][group_id]['position_display'] = position_display
-        
-        selections = (
-            "Bạn đã chọn:\n"
-            f"- {context.user_data['media_groups'][group_id]['crop_display']}\n"
-            f"- {context.user_data['media_groups'][group_id]['logo_display']}\n"
-            f"- {context.user_data['media_groups'][group_id]['position_display']}"
-        )
-        await query.message.reply_text(selections)
-        
-        wait_message = await query.message.reply_text("Chờ trong giây lát...")
-        
-        for img_data in context.user_data['media_groups'][group_id]['images']:
-            logger.info(f"Downloading image file to {img_data['input_path']}")
-            download_start = time.time()
-            try:
-                await img_data['file'].download_to_drive(img_data['input_path'])
-            except Exception as e:
-                logger.error(f"Error downloading image file: {e}")
-                await query.message.reply_text("Error downloading image file. Please try again!")
-                cleanup(context)
-                return
-            logger.info(f"Download took {time.time() - download_start:.2f} seconds")
-        
-        crop_type = context.user_data['media_groups'][group_id].get('crop_type', 'square')
-        
-        async def process_and_send_image(img_data):
-            input_path = img_data['input_path']
-            output_path = img_data['output_path']
-            output_filename = img_data['output_filename']
-            
-            process_start = time.time()
-            success, error_message = process_image(
-                input_path,
-                logo_paths,
-                output_path,
-                crop_type,
-                logo_positions,
-                opacities,
-                logo_choice=logo_choice
-            )
-            if success:
-                logger.info(f"Image processing took {time.time() - process_start:.2f} seconds")
-                send_start = time.time()
-                with open(output_path, 'rb') as output_file:
-                    await query.message.reply_document(document=output_file, filename=output_filename)
-                logger.info(f"Sending file took {time.time() - send_start:.2f} seconds")
-                return True
-            else:
-                await query.message.reply_text(f"Error processing image {output_filename}: {error_message}")
-                return False
-        
-        logger.info(f"Processing images for group_id={group_id} with logo {logo_choice} at position {position} with opacity {opacity}")
-        tasks = [process_and_send_image(img_data) for img_data in context.user_data['media_groups'][group_id]['images']]
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        context.user_data['media_groups'][group_id]['processed'] = all(result is True for result in results if not isinstance(result, Exception))
-        
-        try:
-            await wait_message.delete()
-        except BadRequest:
-            logger.debug("Cannot delete wait message.")
-        
-        logger.info(f"Finished processing group_id={group_id}, cleaning up")
-        if group_id in context.user_data['media_groups']:
-            del context.user_data['media_groups'][group_id]
-        if not context.user_data['media_groups']:
-            cleanup(context)
+        await finish_logo_selection(query, context, group_id, position, opacity, f"Ở giữa - mờ {int(opacity * 100)}%")
         return
     
     group_id = callback_data[2]
@@ -734,98 +1420,296 @@ async def handle_position_selection(update: Update, context: ContextTypes.DEFAUL
         logger.debug("Cannot delete position selection message.")
     
     position = callback_data[1]
-    logo_choice = context.user_data['media_groups'][group_id]['logo_choice']
-    logger.info(f"Selected logo_choice: {logo_choice}, position: {position} for group_id={group_id}")
-    
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    logo_path = os.path.join(script_dir, 'Logo', f"{logo_choice}.png")
-    logo_paths = [logo_path]
-    logo_positions = [position]
-    opacities = [1.0]
-    
-    position_display = (
-        "Góc trên - trái" if position == 'top-left' else
-        "Góc trên - phải" if position == 'top-right' else
-        "Góc dưới - trái" if position == 'bottom-left' else
-        "Góc dưới - phải" if position == 'bottom-right' else
-        "Giữa - Phía trên" if position == 'middle-top' else
-        "Giữa - Phía dưới" if position == 'middle-bottom' else
-        "Unknown position"
-    )
+    await finish_logo_selection(query, context, group_id, position, 1.0, POSITION_LABELS.get(position, "Unknown position"))
+
+async def finish_logo_selection(query, context, group_id, position, opacity, position_display):
+    group = context.user_data['media_groups'][group_id]
+    logo_choice = group['logo_choice']
+    logger.info(f"Selected logo_choice: {logo_choice}, position: {position}, opacity: {opacity} for group_id={group_id}")
+    group['position_display'] = position_display
+    group.setdefault('logos', []).append({
+        'logo_choice': logo_choice,
+        'position': position,
+        'opacity': opacity,
+        'logo_display': group['logo_display'],
+        'position_display': position_display,
+    })
     
-    context.user_data['media_groups'][group_id]['position_display'] = position_display
+    if group.get('multi_logo'):
+        logger.info(f"Asking for more logos for group_id={group_id}, logos so far: {len(group['logos'])}")
+        await ask_for_more_logos(context.bot, group['chat_id'], group_id, len(group['logos']))
+        return
     
-    selections = (
-        "Bạn đã chọn:\n"
-        f"- {context.user_data['media_groups'][group_id]['crop_display']}\n"
-        f"- {context.user_data['media_groups'][group_id]['logo_display']}\n"
-        f"- {context.user_data['media_groups'][group_id]['position_display']}"
-    )
-    await query.message.reply_text(selections)
+    await process_group(query.message, context, group_id)
+
+async def download_image(img_data):
+    logger.info(f"Downloading image file to {img_data['input_path']}")
+    download_start = time.time()
+    try:
+        await img_data['file'].download_to_drive(img_data['input_path'])
+    except Exception as e:
+        logger.error(f"Error downloading image file: {e}")
+        return False
+    logger.info(f"Download took {time.time() - download_start:.2f} seconds")
+    return True
+
+async def process_group(message, context, group_id, interactive=True):
+    # interactive=False (preset): không gửi tin nhắn xác nhận/chờ và không có bước preview
+    group = context.user_data['media_groups'][group_id]
+    logos = group.get('logos', [])
+    logo_paths, logo_positions, opacities = [], [], []
+    for logo in logos:
+        paths, positions, logo_opacities = build_logo_job(logo['logo_choice'], logo['position'], logo['opacity'])
+        logo_paths += paths
+        logo_positions += positions
+        opacities += logo_opacities
+    logo_choice = ','.join(logo['logo_choice'] for logo in logos)
     
-    wait_message = await query.message.reply_text("Chờ trong giây lát...")
+    group['render_generation'] = generation = group.get('render_generation', 0) + 1
     
-    for img_data in context.user_data['media_groups'][group_id]['images']:
-        logger.info(f"Downloading image file to {img_data['input_path']}")
-        download_start = time.time()
-        try:
-            await img_data['file'].download_to_drive(img_data['input_path'])
-        except Exception as e:
-            logger.error(f"Error downloading image file: {e}")
-            await query.message.reply_text("Error downloading image file. Please try again!")
-            cleanup(context)
-            return
-        logger.info(f"Download took {time.time() - download_start:.2f} seconds")
+    # Tải mọi ảnh song song ngay lập tức; task được giữ lại để lần render lại không tải lại
+    for img_data in group['images']:
+        if 'download' not in img_data:
+            img_data['download'] = asyncio.create_task(download_image(img_data))
+    
+    selection = {'crop_type': group.get('crop_type', 'square'), 'crop_display': group['crop_display'], 'logos': logos}
+    announce_task = None
+    if interactive:
+        context.chat_data['last_selection'] = copy.deepcopy(selection)
+        
+        async def announce():
+            await message.reply_text("Bạn đã chọn:\n" + describe_selection(selection))
+            return await message.reply_text("Chờ trong giây lát...")
+        
+        # Tin nhắn xác nhận chạy song song với tải/decode, preview và ảnh kết quả chỉ chờ nó để giữ thứ tự
+        announce_task = asyncio.create_task(announce())
     
-    crop_type = context.user_data['media_groups'][group_id].get('crop_type', 'square')
+    crop_type = group.get('crop_type', 'square')
+    preview_tasks = []
+    # Các ảnh còn lại chờ preview của ảnh đầu render xong để không chiếm render pool trước nó
+    preview_gate = asyncio.Event() if interactive and PREVIEW_ENABLED else None
     
-    async def process_and_send_image(img_data):
+    async def send_preview(source):
+        # Preview được upload song song trong lúc ảnh full-res tiếp tục render
+        preview_crop = CROP_VARIANTS[0][0] if crop_type == 'all' else crop_type
+        try:
+            preview = await asyncio.get_running_loop().run_in_executor(
+                render_pool, render_preview, source, preview_crop, logo_paths, logo_positions, opacities
+            )
+        finally:
+            preview_gate.set()
+        keyboard = [[
+            InlineKeyboardButton("Ổn rồi", callback_data=f"preview_ok_{group_id}"),
+            InlineKeyboardButton("Đổi vị trí logo", callback_data=f"preview_redo_{group_id}")
+        ]]
+        
+        async def upload_preview():
+            await announce_task
+            return await message.reply_photo(
+                photo=preview,
+                caption="Xem trước - ảnh chất lượng cao đang được xử lý",
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+        
+        preview_tasks.append(asyncio.create_task(upload_preview()))
+    
+    async def process_and_send_image(img_data, on_source=None):
         input_path = img_data['input_path']
-        output_path = img_data['output_path']
         output_filename = img_data['output_filename']
         
+        if not await img_data['download']:
+            if announce_task is not None:
+                await announce_task
+            await message.reply_text(f"Error downloading image file {output_filename}. Please try again!")
+            return False
+        if preview_gate is not None and on_source is None:
+            await preview_gate.wait()
+        
+        # Mỗi lần render lại ghi ra file riêng để không đè lên file của lần render trước còn đang chạy
+        output_stem = os.path.splitext(img_data['output_path'])[0] + (f"_{generation}" if generation > 1 else "")
+        if crop_type == 'all':
+            variants = [(variant_crop, f"{output_stem}_{suffix}.jpg") for variant_crop, suffix in CROP_VARIANTS]
+            filenames = [f"{img_data['base_name']}_{suffix}_edit.jpg" for _, suffix in CROP_VARIANTS]
+        else:
+            variants = [(crop_type, f"{output_stem}.jpg")]
+            filenames = [output_filename]
+        
         process_start = time.time()
-        success, error_message = process_image(
+        results = await render_image_variants(
             input_path,
+            variants,
             logo_paths,
-            output_path,
-            crop_type,
             logo_positions,
             opacities,
-            logo_choice=logo_choice
+            logo_choice=logo_choice,
+            cache_source=interactive and PREVIEW_ENABLED,
+            on_source=on_source
         )
-        if success:
+        if group['render_generation'] != generation:
+            logger.info(f"Discarding outdated render of {input_path} for group_id={group_id}")
+            return False
+        rendered = [(output_path, filename) for (success, _), (_, output_path), filename in zip(results, variants, filenames) if success]
+        if announce_task is not None:
+            await announce_task
+        if rendered:
             logger.info(f"Image processing took {time.time() - process_start:.2f} seconds")
             send_start = time.time()
-            with open(output_path, 'rb') as output_file:
-                await query.message.reply_document(document=output_file, filename=output_filename)
+            if len(rendered) == 1:
+                with open(rendered[0][0], 'rb') as output_file:
+                    await message.reply_document(document=output_file, filename=rendered[0][1])
+            else:
+                output_files = [open(output_path, 'rb') for output_path, _ in rendered]
+                try:
+                    await message.reply_media_group(media=[
+                        InputMediaDocument(media=output_file, filename=filename)
+                        for output_file, (_, filename) in zip(output_files, rendered)
+                    ])
+                finally:
+                    for output_file in output_files:
+                        output_file.close()
             logger.info(f"Sending file took {time.time() - send_start:.2f} seconds")
-            return True
-        else:
-            await query.message.reply_text(f"Error processing image {output_filename}: {error_message}")
-            return False
+        for (success, error_message), filename in zip(results, filenames):
+            if not success:
+                await message.reply_text(f"Error processing image {filename}: {error_message}")
+        return all(success for success, _ in results)
     
-    logger.info(f"Processing images for group_id={group_id} with logo {logo_choice} at position {position}")
-    tasks = [process_and_send_image(img_data) for img_data in context.user_data['media_groups'][group_id]['images']]
+    logger.info(f"Processing images for group_id={group_id} with logos {logo_choice} at positions {logo_positions} with opacities {opacities}")
+    async def process_first_image(img_data):
+        try:
+            return await process_and_send_image(img_data, send_preview)
+        finally:
+            # Ảnh đầu lỗi trước khi có preview thì không giữ các ảnh khác
+            preview_gate.set()
+    
+    tasks = [
+        process_first_image(img_data) if preview_gate is not None and index == 0 else process_and_send_image(img_data)
+        for index, img_data in enumerate(group['images'])
+    ]
     results = await asyncio.gather(*tasks, return_exceptions=True)
-    context.user_data['media_groups'][group_id]['processed'] = all(result is True for result in results if not isinstance(result, Exception))
+    preview_results = await asyncio.gather(*preview_tasks, return_exceptions=True)
     
-    try:
-        await wait_message.delete()
-    except BadRequest:
-        logger.debug("Cannot delete wait message.")
+    if announce_task is not None:
+        wait_message = await announce_task
+        try:
+            await wait_message.delete()
+        except BadRequest:
+            logger.debug("Cannot delete wait message.")
+    
+    if group['render_generation'] != generation:
+        logger.info(f"Render of group_id={group_id} was superseded by a new selection")
+        return
+    group['processed'] = all(result is True for result in results if not isinstance(result, Exception))
+    
+    if any(not isinstance(result, Exception) for result in preview_results) and not group.get('approved'):
+        # Giữ nhóm (và ảnh đã decode) đến khi người dùng xác nhận preview hoặc gửi ảnh mới
+        logger.info(f"Finished processing group_id={group_id}, waiting for preview review")
+        group['reviewing'] = True
+        return
     
     logger.info(f"Finished processing group_id={group_id}, cleaning up")
-    if group_id in context.user_data['media_groups']:
-        del context.user_data['media_groups'][group_id]
+    finish_group(context, group_id)
+
+def finish_group(context, group_id):
+    group = context.user_data['media_groups'].pop(group_id, None)
+    if group:
+        for img_data in group['images']:
+            drop_sources(img_data['input_path'])
     if not context.user_data['media_groups']:
         cleanup(context)
 
+async def handle_preview_review(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    try:
+        await query.answer()
+    except BadRequest as e:
+        logger.warning(f"Cannot answer CallbackQuery: {str(e)}. Continuing.")
+    
+    logger.info(f"Received preview callback: {query.data}")
+    
+    callback_data = query.data.split('_')
+    if len(callback_data) < 3 or callback_data[0] != 'preview':
+        logger.error(f"Invalid preview callback data: {query.data}")
+        await query.message.reply_text("Invalid selection!")
+        return
+    
+    action = callback_data[1]
+    group_id = callback_data[2]
+    
+    try:
+        await query.edit_message_reply_markup(reply_markup=None)
+    except BadRequest:
+        logger.debug("Cannot remove preview buttons.")
+    
+    if 'media_groups' not in context.user_data or group_id not in context.user_data['media_groups']:
+        logger.info(f"Preview review for finished group_id={group_id}, ignoring")
+        return
+    
+    group = context.user_data['media_groups'][group_id]
+    if action == 'ok':
+        logger.info(f"User approved preview for group_id={group_id}")
+        if group.get('reviewing'):
+            finish_group(context, group_id)
+        else:
+            group['approved'] = True
+        return
+    
+    # Đổi vị trí: bỏ logo vừa chọn, các lần render đang chạy sẽ không gửi kết quả
+    logger.info(f"User asked to change logo position for group_id={group_id}")
+    group['render_generation'] = group.get('render_generation', 0) + 1
+    group['processed'] = False
+    group['reviewing'] = False
+    group['approved'] = False
+    if group.get('logos'):
+        group['logos'].pop()
+    await ask_for_position(context.bot, group['chat_id'], group_id, group['logo_choice'], include_back=True)
+
+async def handle_more_logos(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    try:
+        await query.answer()
+    except BadRequest as e:
+        logger.warning(f"Cannot answer CallbackQuery: {str(e)}. Continuing.")
+    
+    logger.info(f"Received more logos callback: {query.data}")
+    
+    callback_data = query.data.split('_')
+    if len(callback_data) < 3 or callback_data[0] != 'more':
+        logger.error(f"Invalid more logos callback data: {query.data}")
+        await query.message.reply_text("Invalid selection!")
+        cleanup(context)
+        return
+    
+    action = callback_data[1]
+    group_id = callback_data[2]
+    
+    if 'media_groups' not in context.user_data or group_id not in context.user_data['media_groups']:
+        logger.error(f"No media group found for group_id={group_id} in handle_more_logos")
+        await query.message.reply_text("No images to process, please send images again!")
+        cleanup(context)
+        return
+    
+    if context.user_data['media_groups'][group_id].get('processed', False):
+        logger.info(f"Ignoring duplicate more logos callback for group_id={group_id}")
+        return
+    
+    try:
+        await query.message.delete()
+    except BadRequest:
+        logger.debug("Cannot delete more logos message.")
+    
+    if action == 'add':
+        logger.info(f"User selected add another logo for group_id={group_id}")
+        await ask_for_logo(context.bot, context.user_data['media_groups'][group_id]['chat_id'], group_id, include_multi=False)
+        return
+    
+    await process_group(query.message, context, group_id)
+
 def cleanup(context: ContextTypes.DEFAULT_TYPE):
     if context is None or context.user_data is None:
         logger.warning("Context or user_data is None in cleanup")
         return
     if 'temp_dir' in context.user_data:
+        drop_sources(context.user_data['temp_dir'])
         shutil.rmtree(context.user_data['temp_dir'], ignore_errors=True)
     context.user_data.clear()
 
@@ -838,20 +1722,88 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("An error occurred. Please try again later!")
     cleanup(context)
 
-def run_fastapi():
-    uvicorn.run(app, host="0.0.0.0", port=8080, forwarded_allow_ips="*")
+async def ensure_webhook(webhook_url):
+    try:
+        info = await application.bot.get_webhook_info()
+        if info.url == webhook_url:
+            logger.info(f"Webhook already set to {webhook_url}, skipping set_webhook")
+            return
+        await application.bot.set_webhook(url=webhook_url)
+        logger.info(f"Webhook set to {webhook_url}")
+    except Exception as e:
+        logger.error(f"Failed to set webhook: {str(e)}")
+        raise
+
+async def process_queued_update(data):
+    try:
+        await application.process_update(Update.de_json(data, application.bot))
+    except Exception as e:
+        logger.error(f"Error processing queued update: {str(e)}")
+
+async def drain_pending_updates():
+    # Bật ready trước, các update đã xếp hàng chạy song song như request webhook thường
+    global bot_ready
+    bot_ready = True
+    queued = pending_updates[:]
+    pending_updates.clear()
+    for data in queued:
+        task = asyncio.create_task(process_queued_update(data))
+        _queued_update_tasks.add(task)
+        task.add_done_callback(_queued_update_tasks.discard)
+    return len(queued)
+
+def log_startup_report():
+    report = ", ".join(f"{name}={seconds:.3f}s" for name, seconds in startup_report.items())
+    logger.info(f"Startup report: {report}")
+
+async def run_bot(webhook_url, logo_paths):
+    # Khởi động HTTP server trước để nhận webhook ngay, update sẽ được xếp hàng đến khi bot sẵn sàng
+    config = uvicorn.Config(app, host="0.0.0.0", port=8080, forwarded_allow_ips="*")
+    server = uvicorn.Server(config)
+    server_task = asyncio.create_task(server.serve())
+    warm_up_task = asyncio.get_running_loop().run_in_executor(None, warm_up, logo_paths)
+    try:
+        while not server.started and not server_task.done():
+            await asyncio.sleep(0.01)
+        startup_report['server_listening'] = round(time.perf_counter() - _startup_t0, 3)
+
+        step_start = time.perf_counter()
+        await application.initialize()
+        startup_report['application_initialize'] = round(time.perf_counter() - step_start, 3)
+
+        step_start = time.perf_counter()
+        await ensure_webhook(webhook_url)
+        startup_report['webhook'] = round(time.perf_counter() - step_start, 3)
+
+        drained = await drain_pending_updates()
+        startup_report['ready'] = round(time.perf_counter() - _startup_t0, 3)
+        logger.info(f"Bot ready, scheduled {drained} queued updates")
+
+        try:
+            await warm_up_task
+        except Exception as e:
+            logger.warning(f"Warm-up failed, codecs will load on first image: {str(e)}")
+        log_startup_report()
+
+        await server_task
+    finally:
+        logger.info("Stopping bot...")
+        if not server_task.done():
+            server.should_exit = True
+            await server_task
+        # Giữ nguyên webhook khi tắt để Telegram tiếp tục gửi lại update trong lúc khởi động lại
+        await application.shutdown()
 
 def main():
     global application
-    # Kiểm tra logo files
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    logo_files = ['kenh14.png', 'disoi.png', 'AI.png', 'gd.png']
-    logo_dir = os.path.join(script_dir, 'Logo')
-    for logo in logo_files:
-        logo_path = os.path.join(logo_dir, logo)
+    startup_report['imports'] = round(time.perf_counter() - _startup_t0, 3)
+    # Kiểm tra logo files trong registry
+    logo_paths = [entry['path'] for entry in logo_registry.values()]
+    for logo_path in logo_paths:
         if not os.path.exists(logo_path):
             logger.error(f"Logo file does not exist: {logo_path}. Bot will stop.")
             return
+    init_preset_db()
 
     # Lấy token và webhook URL từ biến môi trường
     token = os.getenv("TELEGRAM_TOKEN")
@@ -865,42 +1817,158 @@ def main():
 
     # Thêm các handler
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("preset", preset_command))
     application.add_handler(MessageHandler(filters.PHOTO | filters.Document.IMAGE, handle_media))
     application.add_handler(CallbackQueryHandler(handle_crop_selection, pattern='^crop_'))
     application.add_handler(CallbackQueryHandler(handle_logo_selection, pattern='^(logo_|back_to_crop_)'))
     application.add_handler(CallbackQueryHandler(handle_position_selection, pattern='^(pos_|opacity_|back_to_logo_|back_to_position_)'))
+    application.add_handler(CallbackQueryHandler(handle_more_logos, pattern='^more_'))
+    application.add_handler(CallbackQueryHandler(handle_preview_review, pattern='^preview_'))
     application.add_error_handler(error_handler)
 
-    # Thiết lập webhook
-    async def set_webhook():
-        try:
-            await application.bot.delete_webhook()  # Xóa webhook cũ nếu có
-            await application.bot.set_webhook(url=webhook_url)
-            logger.info(f"Webhook set to {webhook_url}")
-        except Exception as e:
-            logger.error(f"Failed to set webhook: {str(e)}")
-            raise
-
-    # Chạy thiết lập webhook
-    loop = asyncio.get_event_loop()
     try:
-        loop.run_until_complete(application.initialize())  # Khởi tạo application
-        loop.run_until_complete(set_webhook())
-        # Khởi động FastAPI trong một thread riêng
-        fastapi_thread = threading.Thread(target=run_fastapi, daemon=True)
-        fastapi_thread.start()
-        # Giữ chương trình chạy
-        loop.run_forever()
+        asyncio.run(run_bot(webhook_url, logo_paths))
     except KeyboardInterrupt:
         logger.info("Received shutdown signal, stopping bot...")
-        loop.run_until_complete(application.bot.delete_webhook())
-        loop.run_until_complete(application.stop())
-        loop.close()
     except Exception as e:
         logger.error(f"Error in main loop: {str(e)}")
-        loop.run_until_complete(application.bot.delete_webhook())
-        loop.run_until_complete(application.stop())
-        loop.close()
+
+# Chạy batch từ dòng lệnh: python bk.py batch <thư mục|glob> --crop square --logo kenh14 --position top-left
+BATCH_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.heic', '.heif')
+BATCH_MANIFEST = '.render_manifest.json'
+def collect_batch_inputs(pattern):
+    if os.path.isdir(pattern):
+        paths = [os.path.join(pattern, name) for name in sorted(os.listdir(pattern))]
+    else:
+        paths = sorted(glob.glob(pattern, recursive=True))
+    return [path for path in paths if os.path.isfile(path) and (path.lower().endswith(BATCH_IMAGE_EXTENSIONS) or is_heif_file(path))]
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def hash_render_job(input_path, params):
+    digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode())
+    with open(input_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def render_file(input_path, logo_paths, output_path, crop_type, logo_positions, opacities, logo_choice):
+    # Cùng đường decode/draft như render_image, nhưng chạy đồng bộ trong process con của batch
+    width, height, mode, image_format = probe_image(input_path)
+    draft_scale = choose_draft_scale(width, height, mode, image_format)
+    return process_image(input_path, logo_paths, output_path, crop_type, logo_positions, opacities, logo_choice=logo_choice, draft_scale=draft_scale)
+
+def run_batch(argv):
+    parser = argparse.ArgumentParser(prog='bk.py batch', description='Render a folder of images with the bot pipeline.')
+    parser.add_argument('input', help='Input directory or glob pattern')
+    parser.add_argument('-o', '--output', default='output', help='Output directory')
+    parser.add_argument('--crop', choices=['square', '4:5', 'keep'], default='square')
+    parser.add_argument('--logo', choices=LOGO_CHOICES + ['no_logo'], default='kenh14')
+    parser.add_argument('--position', choices=LOGO_POSITIONS, default='top-left')
+    parser.add_argument('--opacity', type=float, default=1.0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args(argv)
+    if not 0 < args.opacity <= 1:
+        parser.error(f"--opacity must be in (0, 1], got {args.opacity}")
+    if args.logo != 'no_logo' and args.position not in logo_registry[args.logo]['positions']:
+        parser.error(f"--position {args.position} is not available for logo {args.logo}")
+
+    inputs = collect_batch_inputs(args.input)
+    if not inputs:
+        logger.error(f"No images found for {args.input}")
+        return 1
+    os.makedirs(args.output, exist_ok=True)
+
+    logo_paths, logo_positions, opacities = build_logo_job(args.logo, args.position, args.opacity)
+    # Thông số registry và nội dung file logo nằm trong hash: sửa logo/logos.json thì render lại
+    params = {
+        'crop': args.crop, 'logo': args.logo, 'positions': logo_positions, 'opacities': opacities,
+        'logos': [{'entry': get_logo_entry(logo_path), 'sha256': file_sha256(logo_path)} for logo_path in logo_paths],
+    }
+
+    manifest_path = os.path.join(args.output, BATCH_MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    jobs = []
+    skipped = 0
+    used_names = set()
+    for input_path in inputs:
+        output_filename = unique_output_filename(os.path.splitext(os.path.basename(input_path))[0], used_names)
+        output_path = os.path.join(args.output, output_filename)
+        job_hash = hash_render_job(input_path, params)
+        if manifest.get(output_filename) == job_hash and os.path.exists(output_path):
+            skipped += 1
+            continue
+        jobs.append((input_path, output_filename, output_path, job_hash))
+    logger.info(f"Batch: {len(inputs)} images, {skipped} already rendered, {len(jobs)} to render with {args.workers} workers")
+
+    batch_start = time.time()
+    done = 0
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {
+            executor.submit(render_file, input_path, logo_paths, output_path, args.crop, logo_positions, opacities, args.logo): (input_path, output_filename, job_hash)
+            for input_path, output_filename, output_path, job_hash in jobs
+        }
+        for future in as_completed(futures):
+            input_path, output_filename, job_hash = futures[future]
+            try:
+                success, message = future.result()
+            except Exception as e:
+                success, message = False, str(e)
+            done += 1
+            if success:
+                manifest[output_filename] = job_hash
+                with open(manifest_path, 'w') as f:
+                    json.dump(manifest, f, indent=2)
+            else:
+                failed += 1
+                logger.error(f"Failed to render {input_path}: {message}")
+            elapsed = time.time() - batch_start
+            logger.info(f"[{done}/{len(jobs)}] {output_filename} - {done / elapsed:.2f} images/s")
+
+    elapsed = time.time() - batch_start
+    logger.info(f"Batch finished: {done - failed} rendered, {failed} failed, {skipped} skipped in {elapsed:.2f} seconds")
+    return 1 if failed else 0
+
+# Kiểm tra hồi quy cho resize theo dải: python bk.py check-strips
+def check_strip_tolerance(width=7000, height=5000):
+    # So sánh resize_in_strips với đường crop + resize thường trên ảnh nhiễu cho từng mode/crop
+    # (7000x5000: tỉ lệ scale không nguyên nên có làm tròn ở mép dải),
+    # sai khác phải nằm trong TILED_MAX_PIXEL_DIFF (alpha mẫu >= 64 như giới hạn đã ghi)
+    load_codecs()
+    import random
+    from PIL import ImageChops
+    rng = random.Random(0)
+    noise = [Image.frombytes('L', (width, height), rng.randbytes(width * height)) for _ in range(3)]
+    alpha = Image.linear_gradient('L').resize((width, height)).point(lambda v: 64 + v * 191 // 255)
+    samples = {'L': noise[0], 'RGB': Image.merge('RGB', noise), 'RGBA': Image.merge('RGBA', noise + [alpha])}
+    failures = []
+    for mode, img in samples.items():
+        for crop_type in ('square', '4:5', 'keep'):
+            crop_box, target_size = compute_crop_geometry(width, height, crop_type)
+            strips = resize_in_strips(img, crop_box, target_size)
+            normal = img.crop(crop_box).resize(target_size, Image.LANCZOS)
+            extrema = ImageChops.difference(strips, normal).getextrema()
+            max_diff = max(high for _, high in (extrema if mode != 'L' else [extrema]))
+            logger.info(f"Strip resize {mode} {crop_type}: max diff {max_diff}, limit {TILED_MAX_PIXEL_DIFF[mode]}")
+            if max_diff > TILED_MAX_PIXEL_DIFF[mode]:
+                failures.append((mode, crop_type, max_diff))
+    if failures:
+        logger.error(f"Strip resize exceeds TILED_MAX_PIXEL_DIFF: {failures}")
+    return 1 if failures else 0
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        sys.exit(run_batch(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'check-strips':
+        sys.exit(check_strip_tolerance())
     main()